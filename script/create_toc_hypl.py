@@ -15,123 +15,178 @@
 #   - Requires Python 3 and PyMuPDF installed (`pip install pymupdf`).
 # ****************************************************************************************************
 
+import os
 import sys
 import fitz  # PyMuPDF
 import math
+from itertools import accumulate, groupby
+from operator import itemgetter
 
 def extract_toc_entries(doc):
     toc = doc.get_toc(simple=True)
     entries = []
+    title_words = {}  # repeated titles share one word list
     for entry in toc:
         level, title, page_num = entry[:3]
-        entries.append((level, title.strip(), page_num - 1))  # 0-based page numbers
+        title = title.strip()
+        words = title_words.get(title)
+        if words is None:
+            words = title_words[title] = title.split()
+        entries.append((level, title, words, page_num - 1))  # 0-based page numbers
     return entries
 
-def wrap_text(text, font_size, max_width):
-    words = text.split()
+def build_char_widths(titles, font, font_size):
+    # Width of every character the TOC can contain, measured once per run
+    chars = set("".join(titles)) | set(" .0123456789")
+    return {c: font.text_length(c, fontsize=font_size) for c in chars}
+
+def text_width(text, char_w):
+    return sum(char_w[c] for c in text)
+
+def wrap_text(words, char_w, max_width):
+    space_width = char_w[" "]
     lines = []
     current_line = ""
+    current_width = 0
     for word in words:
-        test_line = current_line + (" " if current_line else "") + word
-        if fitz.get_text_length(test_line, fontsize=font_size) <= max_width:
-            current_line = test_line
+        word_width = text_width(word, char_w)
+        test_width = current_width + space_width + word_width if current_line else word_width
+        if test_width <= max_width:
+            current_line = current_line + (" " if current_line else "") + word
+            current_width = test_width
         else:
             if current_line:
                 lines.append(current_line)
             current_line = word
+            current_width = word_width
     if current_line:
         lines.append(current_line)
     return lines
 
-def paginate_wrapped_entries(toc_entries, font_size, max_width, lines_per_page):
-    paginated_entries = []
-    current_page_entries = []
+def split_pages(line_counts, lines_per_page):
+    # Indices of the entries that start a new TOC page
+    boundaries = []
     current_line_count = 0
-
-    for entry in toc_entries:
-        level, title, target_page = entry
-        indent = 20 * (level - 1)
-        available_width = max_width - indent
-        wrapped_lines = wrap_text(title, font_size, available_width)
-        line_count = len(wrapped_lines)
-
+    for i, line_count in enumerate(line_counts):
         if current_line_count + line_count > lines_per_page:
-            paginated_entries.append(current_page_entries)
-            current_page_entries = []
+            boundaries.append(i)
             current_line_count = 0
-
-        current_page_entries.append((entry, wrapped_lines))
         current_line_count += line_count
+    return boundaries
 
-    if current_page_entries:
-        paginated_entries.append(current_page_entries)
+def paginate_wrapped_entries(levels, titles, title_words, char_w, max_width, lines_per_page):
+    # Returns the wrapped lines of every entry and the (start, end) entry range of every TOC page
+    wrapped_titles = []
+    wrap_cache = {}  # repeated titles at the same level are wrapped only once
+    for level, title, words in zip(levels, titles, title_words):
+        indent = 20 * (level - 1)
+        available_width = max_width - indent
+        key = (title, available_width)
+        wrapped_lines = wrap_cache.get(key)
+        if wrapped_lines is None:
+            wrapped_lines = wrap_cache[key] = wrap_text(words, char_w, available_width)
+        wrapped_titles.append(wrapped_lines)
+
+    if not wrapped_titles:
+        return wrapped_titles, []
 
-    return paginated_entries
+    boundaries = split_pages([len(wrapped_lines) for wrapped_lines in wrapped_titles], lines_per_page)
+    starts = [0] + boundaries
+    ends = boundaries + [len(wrapped_titles)]
+    return wrapped_titles, list(zip(starts, ends))
 
-def generate_toc_pages(paginated_entries, font_size, page_width, page_height):
-    toc_doc = fitz.open()
+def generate_toc_pages(doc, page_ranges, levels, wrapped_titles, target_pages, char_w, font, font_size, page_width, page_height):
     link_targets = []
     left_margin = 50
     right_margin = 60
     top_margin = 50
     y_spacing = font_size * 1.5
 
-    toc_page_count = len(paginated_entries)
-
-    for page_index, entries in enumerate(paginated_entries):
-        page = toc_doc.new_page(width=page_width, height=page_height)
-        y = top_margin
-        for (level, title, target_page), wrapped_lines in entries:
-            indent = 20 * (level - 1)
-            x = left_margin + indent
-            page_number_str = str(target_page + toc_page_count + 1)
-            page_number_width = fitz.get_text_length(page_number_str, fontsize=font_size)
-            max_x_for_dots = page_width - right_margin - page_number_width - 5
-
-            first_line_y = y  # Needed for hyperlink rectangle
+    toc_page_count = len(page_ranges)
+    right_edge = page_width - right_margin
+
+    # Page number label and width per target page, shared by entries pointing to the same page
+    page_numbers = {}
+    for target_page in set(target_pages):
+        page_number_str = str(target_page + toc_page_count + 1)
+        page_numbers[target_page] = (page_number_str, text_width(page_number_str, char_w))
+
+    # Dot leaders repeat at the advance of a '.' glyph, as a row of typed dots would
+    dot_w = char_w["."]
+    leader_dashes = f"[{dot_w / 3:g} {dot_w * 2 / 3:g}] 0"
+
+    # x position of every entry, from its level
+    entry_xs = [left_margin + 20 * (level - 1) for level in levels]
+
+    for page_index, (start, end) in enumerate(page_ranges):
+        page = doc.new_page(pno=page_index, width=page_width, height=page_height)
+        writer = fitz.TextWriter(page.rect)  # all text of the page is written in one go
+        leaders = page.new_shape()  # likewise for the dot leaders
+        # y position of the first line of every entry on the page, plus the end of the last one
+        entry_ys = [top_margin + line_count * y_spacing for line_count in
+                    accumulate((len(wrapped_titles[k]) for k in range(start, end)), initial=0)]
+        for k in range(start, end):
+            x, wrapped_lines, target_page = entry_xs[k], wrapped_titles[k], target_pages[k]
+            first_line_y = entry_ys[k - start]
+            page_number_str, page_number_width = page_numbers[target_page]
+            page_number_x = right_edge - page_number_width
+            max_x_for_dots = page_number_x - 5
+            last_line = len(wrapped_lines) - 1
 
             for i, line in enumerate(wrapped_lines):
-                line_width = fitz.get_text_length(line, fontsize=font_size)
-                dots = ''
-                if i == len(wrapped_lines) - 1:
-                    dots_space = max_x_for_dots - (x + line_width + 10)
-                    dot_count = max(0, int(dots_space / fitz.get_text_length('.', fontsize=font_size)))
-                    dots = '.' * dot_count
-
-                    # Draw line with dots and page number
-                    page.insert_text((x, y), f"{line} {dots}", fontsize=font_size)
-                    page.insert_text((page_width - right_margin - page_number_width, y), page_number_str, fontsize=font_size)
+                y = first_line_y + i * y_spacing
+                if i == last_line:
+                    line_width = text_width(line, char_w)
+                    dots_start = x + line_width + 4
+
+                    # Draw line, dotted leader and page number
+                    writer.append((x, y), line, font=font, fontsize=font_size)
+                    if dots_start < max_x_for_dots:
+                        leaders.draw_line((dots_start, y - 1), (max_x_for_dots, y - 1))
+                    writer.append((page_number_x, y), page_number_str, font=font, fontsize=font_size)
                 else:
                     # Draw line without dots/page number
-                    page.insert_text((x, y), line, fontsize=font_size)
+                    writer.append((x, y), line, font=font, fontsize=font_size)
 
-                y += y_spacing
+            link_targets.append((page_index, (x, first_line_y - font_size, right_edge, entry_ys[k - start + 1]), target_page))
 
-            rect = fitz.Rect(x, first_line_y - font_size, page_width - right_margin, y)
-            link_targets.append((page_index, rect, target_page))
+        writer.write_text(page)
+        leaders.finish(width=0.5, dashes=leader_dashes, closePath=False)
+        leaders.commit()
 
-    return toc_doc, link_targets
+    return link_targets
 
 def add_toc_hyperlinks(doc, link_targets, toc_page_count):
-    for toc_page_index, rect, target_page in link_targets:
-        doc[toc_page_index].insert_link({
-            "kind": fitz.LINK_GOTO,
-            "from": rect,
-            "page": target_page + toc_page_count
-        })
+    link = {"kind": fitz.LINK_GOTO, "from": None, "page": 0}  # reused for every link
+    # link_targets are in TOC page order, so each page is loaded only once
+    for toc_page_index, page_targets in groupby(link_targets, key=itemgetter(0)):
+        page = doc[toc_page_index]
+        for _, rect, target_page in page_targets:
+            link["from"] = fitz.Rect(rect)
+            link["page"] = target_page + toc_page_count
+            page.insert_link(link)
 
 def shift_bookmark_pages(bookmarks, offset):
-    shifted = []
-    for bm in bookmarks:
-        if len(bm) >= 3:
-            level, title, page_num = bm[:3]
-            shifted.append([level, title, page_num + offset])
-    return shifted
+    return [[bm[0], bm[1], bm[2] + offset] for bm in bookmarks if len(bm) >= 3]
 
 def add_existing_bookmarks(doc, bookmarks, offset):
     shifted = shift_bookmark_pages(bookmarks, offset)
     doc.set_toc(shifted)
 
+def save_pdf(doc, input_pdf, output_pdf):
+    # Drop only unreferenced objects, such as the outline items replaced by set_toc; streams are not
+    # recompressed or cleaned
+    options = {"garbage": 1, "deflate": False, "clean": False}
+    if os.path.normcase(os.path.realpath(output_pdf)) == os.path.normcase(os.path.realpath(input_pdf)):
+        # MuPDF only saves over the opened file incrementally, so write the new PDF from memory instead
+        pdf_bytes = doc.tobytes(**options)
+        doc.close()
+        with open(output_pdf, "wb") as f:
+            f.write(pdf_bytes)
+    else:
+        doc.save(output_pdf, **options)
+        doc.close()
+
 def main():
     if len(sys.argv) < 4:
         print("Usage: python create_toc_hypl.py input.pdf output.pdf font_size")
@@ -151,28 +206,34 @@ def main():
 
     width, height = fitz.paper_size("a4")
     max_width = width - 120  # account for left/right margins
+    font = fitz.Font("helv")
+    levels = [level for level, _, _, _ in toc_entries]
+    titles = [title for _, title, _, _ in toc_entries]
+    title_words = [words for _, _, words, _ in toc_entries]
+    target_pages = [target_page for _, _, _, target_page in toc_entries]
+    char_w = build_char_widths(titles, font, font_size)
 
     print("Paginating wrapped TOC entries...")
-    paginated_entries = paginate_wrapped_entries(toc_entries, font_size, max_width, lines_per_page)
-    toc_page_count = len(paginated_entries)
+    wrapped_titles, page_ranges = paginate_wrapped_entries(levels, titles, title_words, char_w,
+                                                           max_width, lines_per_page)
+    toc_page_count = len(page_ranges)
 
     print(f"Generating TOC pages with hyperlinks (Pages: {toc_page_count})...")
-    toc_pdf, link_targets = generate_toc_pages(paginated_entries, font_size, width, height)
+    link_targets = generate_toc_pages(original, page_ranges, levels, wrapped_titles, target_pages,
+                                      char_w, font, font_size, width, height)
 
-    print("Merging TOC and original PDF...")
-    final = fitz.open()
-    final.insert_pdf(toc_pdf)
-    final.insert_pdf(original)
+    # Inserting pages at the front makes MuPDF add or shift /PageLabels, restarting the numbering at the
+    # first body page; clear them (including any of the input's own) to match the TOC's absolute page numbers
+    original.set_page_labels([])
 
     print("Adding TOC hyperlinks...")
-    add_toc_hyperlinks(final, link_targets, toc_page_count)
+    add_toc_hyperlinks(original, link_targets, toc_page_count)
 
     print("Preserving original bookmarks...")
-    add_existing_bookmarks(final, original_bookmarks, toc_page_count)
+    add_existing_bookmarks(original, original_bookmarks, toc_page_count)
 
     print("Saving final PDF...")
-    final.save(output_pdf)
-    final.close()
+    save_pdf(original, input_pdf, output_pdf)
     print(f"Done. Output saved to {output_pdf}")
 
 if __name__ == "__main__":